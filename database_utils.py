@@ -1,5 +1,8 @@
 import requests
-from io import BytesIO
+import hashlib
+import os
+import shutil
+import tempfile
 from zipfile import ZipFile
 import pandas as pd
 import numpy as np
@@ -7,26 +10,65 @@ from scipy.stats import shapiro, normaltest, spearmanr, mannwhitneyu, kruskal, p
 from sklearn.metrics import mean_squared_error, r2_score
 from math import sqrt
 
+# Diretorio onde as bases ja processadas sao armazenadas em formato parquet
+CACHE_DIR = '.cache'
+
+# Versao do formato da base do IDEB em cache; deve ser incrementada ao alterar a forma de leitura da planilha
+IDEB_CACHE_VERSION = 1
+
+# Linhas de cabecalho descartadas e colunas da planilha do IDEB utilizadas no restante do processamento
+IDEB_SKIPROWS = 6
+IDEB_COLUMNS = ['Código da Escola', 'Unnamed: 12', 'Unnamed: 15', 'IDEB\n2017\n(N x P)']
+
+# Mensagens de erro das etapas de processamento
+ERR_GET_IDEB = 'Erro no download dos dados do IDEB. Foi verificada a exceção: '
+ERR_PREPARE_IDEB = 'Erro na preparação dos dados do IDEB. Foi verificada a exceção: '
+ERR_MERGED = 'Erro no gerador de massa de dados. Foi verificada a exceção: '
+
+# Mensagens de interpretacao dos testes de normalidade
+MSG_GAUSS = 'Amostra tem distribuição gaussiana (H0 não foi rejeitada)'
+MSG_NOT_GAUSS = 'Amostra não possui distribuição gaussiana (Rejeita-se H0)'
+
 def GetIdeb(url):
     '''
     Esta funcao realiza o download da base de IDEB acessando o site do INEP
+    Apos o primeiro download a base e armazenada em cache (parquet) e as chamadas seguintes a leem do disco
     Parametros:
     url: url onde consta disponibilizada o arquivo original
     Retorno:
     df: dataframe contendo as informacoes do IDEB
     '''
     try:
-        r = requests.get(url, allow_redirects=True)
-
-        f = ZipFile(BytesIO(r.content))
-        df = f.read('divulgacao_ensino_medio-escolas-2017.xlsx')
-
-        df = pd.read_excel(BytesIO(df), skiprows=6)
+        # A chave do cache considera a url e os parametros de leitura, evitando reutilizar uma base lida de outra forma
+        cache_key = hashlib.sha1(repr((url, IDEB_SKIPROWS, IDEB_COLUMNS)).encode()).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, f'ideb_v{IDEB_CACHE_VERSION}_{cache_key}.parquet')
+        if os.path.exists(cache_path):
+            df = pd.read_parquet(cache_path)
+            print("Arquivo IDEB carregado do cache")
+            return df
+
+        # O arquivo e transferido em blocos para um arquivo temporario em disco, evitando manter o zip inteiro em memoria
+        with tempfile.TemporaryFile() as tmp:
+            with requests.get(url, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, tmp, length=1 << 20)
+            tmp.seek(0)
+
+            with ZipFile(tmp) as f:
+                with f.open('divulgacao_ensino_medio-escolas-2017.xlsx') as member:
+                    # Somente as colunas utilizadas sao lidas; os indicadores sao mantidos como texto para preservar o '-'
+                    df = pd.read_excel(member, skiprows=IDEB_SKIPROWS, engine='openpyxl',
+                                       usecols=lambda c: c in IDEB_COLUMNS,
+                                       dtype=dict.fromkeys(IDEB_COLUMNS[1:], str))
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache_path, compression='zstd')
 
         print("Download do arquivo IDEB concluído")
 
     except Exception as e:
-        raise print("Erro no download dos dados do IDEB. Foi verificada a exceção: " + str(e))
+        raise RuntimeError(f'{ERR_GET_IDEB}{e}') from e
     
     return df
 
@@ -39,22 +81,17 @@ def PrepareIdeb(df):
     ideb: dataframe contendo as informacoes do IDEB apos tratativa
     '''    
     try:
-        ideb = df[['Código da Escola', 'Unnamed: 12', 'Unnamed: 15', 'IDEB\n2017\n(N x P)']]
-        
-        ideb.rename(columns={'Código da Escola' : 'CO_ESCOLA',
-                            'Unnamed: 12' : 'IN_RENDIMENTO',
-                            'Unnamed: 15' : 'NT_PADRONIZADA',
-                            'IDEB\n2017\n(N x P)' : 'IDEB'}, inplace=True)
+        ideb = df.loc[df['Código da Escola'].notna(), IDEB_COLUMNS].copy()
+        ideb.columns = ['CO_ESCOLA', 'IN_RENDIMENTO', 'NT_PADRONIZADA', 'IDEB']
 
-        ideb = ideb[ideb['CO_ESCOLA'].notna()]
-        ideb[['IDEB']] = ideb[['IDEB']].replace({'-': np.nan})
-        ideb[['IN_RENDIMENTO']] = ideb[['IN_RENDIMENTO']].replace({'-': np.nan})
-        ideb[['NT_PADRONIZADA']] = ideb[['NT_PADRONIZADA']].replace({'-': np.nan})
-        ideb['CO_ESCOLA'] = ideb['CO_ESCOLA'].astype(str).str[:-2].astype(object)
+        # Os indicadores nao calculados ('-') sao convertidos para nulo
+        cols = ['IDEB', 'IN_RENDIMENTO', 'NT_PADRONIZADA']
+        ideb[cols] = ideb[cols].apply(pd.to_numeric, errors='coerce')
+        ideb['CO_ESCOLA'] = ideb['CO_ESCOLA'].astype('int64')
 
         print('Pré-processamento da base do IDEB concluído')
     except Exception as e:
-        raise print('Erro na preparação dos dados do IDEB. Foi verificada a exceção: ' + str(e))
+        raise RuntimeError(f'{ERR_PREPARE_IDEB}{e}') from e
 
     return ideb
 
@@ -69,36 +106,36 @@ def GetMerged(enem, ideb):
     dfmerge: dataframe contendo a tratativa
     '''
     try:
-        ideb['CO_ESCOLA'] = ideb['CO_ESCOLA'].astype(str)
+        # O codigo da escola e utilizado como chave inteira em ambas as bases (sem alterar o dataframe do ENEM recebido)
+        key = enem['CO_ESCOLA'].astype('int64')
 
-        ideb.sort_values(by=['CO_ESCOLA'], inplace=True)
-        enem.sort_values(by=['CO_ESCOLA'], inplace=True)
-
-        dfmerge = enem.merge(ideb, left_on='CO_ESCOLA', right_on='CO_ESCOLA', how='left')
+        # IDEB e NT_PADRONIZADA são descartados devido ao alto percentual de dados faltantes, por isso somente a taxa de rendimento é incorporada
+        dfmerge = enem.join(ideb.set_index('CO_ESCOLA')[['IN_RENDIMENTO']], on=key, how='left')
         dfmerge.drop(labels=['CO_ESCOLA'], axis=1, inplace=True)
 
-        # Descartando devido ao alto percentual de dados faltantes
-        dfmerge.drop(labels=['IDEB', 'NT_PADRONIZADA'], axis=1, inplace=True)
-
         # As idades faltantes serão substituídas pela idade mediana devido à existência de idades discrepantes
-        dfmerge['NU_IDADE'] = dfmerge['NU_IDADE'].astype('float64')
-        dfmerge['NU_IDADE'].fillna(dfmerge['NU_IDADE'].median(), inplace=True)
-
         # Por se tratar de uma variável nominal, o estado civil e o tipo de ensino serão substituídos pela moda observada (Solteiro e Ensino Regular)
-        dfmerge['TP_ESTADO_CIVIL'].fillna(dfmerge['TP_ESTADO_CIVIL'].mode()[0], inplace=True)
-        dfmerge['TP_ENSINO'].fillna(dfmerge['TP_ENSINO'].mode()[0], inplace=True)
+        # Em caso de empate na moda é escolhido o menor valor, assim como em Series.mode()
+        dfmerge['NU_IDADE'] = dfmerge['NU_IDADE'].astype('float64')
+        values = {'NU_IDADE': dfmerge['NU_IDADE'].median()}
+        for col in ['TP_ESTADO_CIVIL', 'TP_ENSINO']:
+            vc = dfmerge[col].value_counts(dropna=True)
+            values[col] = vc[vc == vc.max()].index.min()
+        dfmerge.fillna(values, inplace=True)
 
         # As taxas de rendimento faltantes serão substituídas pela taxa de rendimento mediana da UF de residência daquele aluno
-        dfmerge['IN_RENDIMENTO'] = dfmerge['IN_RENDIMENTO'].fillna(dfmerge.groupby('SG_UF_RESIDENCIA')['IN_RENDIMENTO'].transform('median'))
+        uf = dfmerge['SG_UF_RESIDENCIA'].astype('category')
+        med_by_uf = dfmerge['IN_RENDIMENTO'].groupby(uf, observed=True).median()
+        dfmerge['IN_RENDIMENTO'] = dfmerge['IN_RENDIMENTO'].fillna(uf.map(med_by_uf).astype('float64'))
         
-        dfmerge = dfmerge.applymap(str)
         cols = ['NU_IDADE', 'NU_NOTA_TOT', 'IN_RENDIMENTO', 'Q005']
-        for col in cols:
-                dfmerge[col] = dfmerge[col].apply(float)
+        non_num = dfmerge.columns.difference(cols)
+        dfmerge[non_num] = dfmerge[non_num].astype(str)
+        dfmerge[cols] = dfmerge[cols].astype('float64')
                 
         print('Gerador de massa de dados concluído com sucesso')
     except Exception as e:
-        raise print("Erro no gerador de massa de dados. Foi verificada a exceção: " + str(e))
+        raise RuntimeError(f'{ERR_MERGED}{e}') from e
     return dfmerge
 
 def NormalityTest(df, alpha = 0.05):
@@ -111,29 +148,25 @@ def NormalityTest(df, alpha = 0.05):
     output: dataframe contendo os resultados dos testes de hipotese para cada variavel numerica
     '''
     input = df.select_dtypes(include = ['float64', 'int64'])
-    output_1 = []
-    output_2 = []
-    # Shapiro Wilk
-    x = 0
-    for x in range(input.shape[1]):
-        stat, p = shapiro(input.iloc[:, x])   
-        if p > alpha:
-            msg = 'Amostra tem distribuição gaussiana (H0 não foi rejeitada)'
-        else:
-            msg = 'Amostra não possui distribuição gaussiana (Rejeita-se H0)'
-        output_1.append([input.iloc[:, x].name, msg])
-    output_1 = pd.DataFrame(output_1, columns = ['Variável', 'Shapiro Wilk Result'])
+    arr = input.to_numpy(dtype=np.float64)
+    colnames = input.columns.tolist()
+    # Sem variaveis numericas nao ha testes a realizar
+    if arr.shape[1] == 0:
+        return pd.DataFrame(columns=['Variável', 'Shapiro Wilk Result', 'D Agostinos K2 Result'])
+    # Shapiro Wilk (o valor-p do scipy nao e preciso para N > 5000, por isso e utilizada uma amostra de 5000 registros)
+    n = arr.shape[0]
+    idx = np.random.default_rng(0).choice(n, size=5000, replace=False) if n > 5000 else slice(None)
+    # A amostra e extraida uma unica vez, com as colunas contiguas em memoria
+    sub = np.asfortranarray(arr[idx])
+    p_sh = np.fromiter((shapiro(sub[:, j])[1] for j in range(sub.shape[1])), dtype=np.float64, count=sub.shape[1])
     # D'Agostino-Pearson
-    x = 0
-    for x in range(input.shape[1]):
-        stat, p = normaltest(input.iloc[:, x])   
-        if p > alpha:
-            msg = 'Amostra tem distribuição gaussiana (H0 não foi rejeitada)'
-        else:
-            msg = 'Amostra não possui distribuição gaussiana (Rejeita-se H0)'
-        output_2.append([input.iloc[:, x].name, msg])
-    output_2 = pd.DataFrame(output_2, columns = ['Variável', 'D Agostinos K2 Result'])
-    output = output_1.merge(output_2, on='Variável', how='inner')
+    _, p_da = normaltest(arr, axis=0)
+    # Codigo 0: H0 nao rejeitada; codigo 1: H0 rejeitada (valores-p nulos tambem rejeitam H0)
+    codes_sh = (~(p_sh > alpha)).astype(np.int8)
+    codes_da = (~(p_da > alpha)).astype(np.int8)
+    output = pd.DataFrame({'Variável': colnames,
+                           'Shapiro Wilk Result': pd.Categorical.from_codes(codes_sh, [MSG_GAUSS, MSG_NOT_GAUSS]),
+                           'D Agostinos K2 Result': pd.Categorical.from_codes(codes_da, [MSG_GAUSS, MSG_NOT_GAUSS])})
     return output
 
 def NonParamTest(df, col, alpha = 0.05):
@@ -147,41 +180,15 @@ def NonParamTest(df, col, alpha = 0.05):
     # Seleciona as variável que irá ser avaliada de acordo com o target
     df_ = df[['NU_NOTA_TOT', col]]
     
-    # k é o número de níveis da variável categórica col selecionada
-    k = df_[col].nunique()
-    
-    # Temos um total de k amostras independentes 
-    samples = []
-    for i in range(k):
-        cat = df_[col].unique()[i]
-        sample = df_[df_[col] == cat].drop(col, axis=1)
-        sample = np.array(sample) 
-        samples.append(sample)
+    # Temos um total de k amostras independentes, uma para cada nível da variável categórica col selecionada
+    samples = [g.to_numpy() for _, g in df_.groupby(col, sort=False, observed=True)['NU_NOTA_TOT']]
+    k = len(samples)
         
     # Comparando as distribuições
     if k == 2:
         stat, p = mannwhitneyu(samples[0], samples[1])
-    elif k  == 3:
-        stat, p = kruskal(samples[0], samples[1], samples[2])
-    elif k  == 4:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3])
-    elif k  == 5:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4])
-    elif k  == 6:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4], samples[5])
-    elif k  == 7:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4], samples[5], samples[6])
-    elif k  == 8:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4], samples[5], samples[6], samples[7])
-    elif k  == 17:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4], samples[5], samples[6], samples[7],
-                          samples[8], samples[9], samples[10], samples[11], samples[12], samples[13], samples[14], samples[15], 
-                          samples[16],  alternative='two-sided')        
-    elif k  == 27:
-        stat, p = kruskal(samples[0], samples[1], samples[2], samples[3], samples[4], samples[5], samples[6], samples[7],
-                          samples[8], samples[9], samples[10], samples[11], samples[12], samples[13], samples[14], samples[15], 
-                          samples[16], samples[17], samples[18], samples[19], samples[20], samples[21], samples[22], samples[23], 
-                          samples[24], samples[25], samples[26], alternative='two-sided')        
+    else:
+        stat, p = kruskal(*samples)
         
     # Interpretando
     if p > alpha: